@@ -3,6 +3,7 @@ from __future__ import division
 
 import os
 import logging
+from multiprocessing import Pool
 import rdkit.Chem as Chem
 from sklearn.preprocessing import LabelEncoder
 
@@ -74,6 +75,26 @@ class RxnDataset(Dataset):
         self.rxns = keep_rxns
 
 
+def _read_rxn_line(line):
+    """Parses one line of a dataset file into the stored reaction entry and
+    the sets of atom and bond feature values it contains. Kept at module
+    level so it can be sent to worker processes.
+    """
+    rxn_smile, edits = line.strip("\r\n ").split()
+    count = rxn_smile.count(":")
+    rxn = Rxn(rxn_smile)
+    mol = Chem.MolFromSmiles('.'.join(filter(None, (rxn.reactants_smile, rxn.reagents_smile))))
+    symbols = set()
+    degrees = set()
+    explicit_valences = set()
+    for atom in mol.GetAtoms():
+        symbols.add(atom.GetSymbol())
+        degrees.add(atom.GetDegree())
+        explicit_valences.add(atom.GetExplicitValence())
+    bond_types = set(bond.GetBondType() for bond in mol.GetBonds())
+    return (rxn, edits, count), symbols, degrees, explicit_valences, bond_types
+
+
 class RxnGraphDataset(RxnDataset):
     """Object for containing sets of reactions SMILES strings.
 
@@ -84,10 +105,11 @@ class RxnGraphDataset(RxnDataset):
                 for mapping data into efficient batches.
 
     """
-    def __init__(self, file_name, path="data/"):
+    def __init__(self, file_name, path="data/", num_workers=0):
         super(RxnGraphDataset, self).__init__(file_name, path)
         self.file_name = file_name
         self.path = path
+        self.num_workers = num_workers
         self.rxns = []
         self.degree_codec = LabelEncoder()
         self.symbol_codec = LabelEncoder()
@@ -105,18 +127,13 @@ class RxnGraphDataset(RxnDataset):
         bond_types = set()
 
         with open(os.path.join(self.path, self.file_name), "r") as datafile:
-            for line in datafile:
-                rxn_smile, edits = line.strip("\r\n ").split()
-                count = rxn_smile.count(":")
-                rxn = Rxn(rxn_smile)
-                self.rxns.append((rxn, edits, count))
-                mol = Chem.MolFromSmiles('.'.join(filter(None, (rxn.reactants_smile, rxn.reagents_smile))))
-                for atom in mol.GetAtoms():
-                    symbols.add(atom.GetSymbol())
-                    degrees.add(atom.GetDegree())
-                    explicit_valences.add(atom.GetExplicitValence())
-                for bond in mol.GetBonds():
-                    bond_types.add(bond.GetBondType())
+            if self.num_workers > 0:
+                with Pool(self.num_workers) as pool:
+                    rxn_infos = pool.imap(_read_rxn_line, datafile, chunksize=1024)
+                    self._add_rxns(rxn_infos, symbols, degrees, explicit_valences, bond_types)
+            else:
+                rxn_infos = map(_read_rxn_line, datafile)
+                self._add_rxns(rxn_infos, symbols, degrees, explicit_valences, bond_types)
         symbols.add("unknown")
         logging.info("Dataset contains {:d} total samples".format(len(self.rxns)))
 
@@ -124,6 +141,18 @@ class RxnGraphDataset(RxnDataset):
         self.symbol_codec.fit(list(symbols))
         self.expl_val_codec.fit(list(explicit_valences))
         self.bond_type_codec.fit(list(bond_types))
+        self.degree_idx = self.index_map(self.degree_codec)
+        self.symbol_idx = self.index_map(self.symbol_codec)
+        self.expl_val_idx = self.index_map(self.expl_val_codec)
+        self.bond_type_idx = self.index_map(self.bond_type_codec)
+
+    def _add_rxns(self, rxn_infos, symbols, degrees, explicit_valences, bond_types):
+        for rxn_info, rxn_symbols, rxn_degrees, rxn_valences, rxn_bond_types in rxn_infos:
+            self.rxns.append(rxn_info)
+            symbols.update(rxn_symbols)
+            degrees.update(rxn_degrees)
+            explicit_valences.update(rxn_valences)
+            bond_types.update(rxn_bond_types)
 
     def __getitem__(self, idx):
         rxn, edits, heavy_count = self.rxns[idx]
@@ -132,11 +161,8 @@ class RxnGraphDataset(RxnDataset):
         atom_idx = torch.tensor([atom.GetIntProp('molAtomMapNumber')-1 for atom in mol.GetAtoms()], dtype=torch.int64)
 
         n_atoms = mol.GetNumAtoms()
-        sparse_idx = []
-        for i in range(n_atoms):
-            for j in range(i+1, n_atoms):
-                sparse_idx.append([atom_idx[i],atom_idx[j]])
-        sparse_idx = torch.tensor(sparse_idx, dtype=torch.int64)
+        pair_idx = torch.triu_indices(n_atoms, n_atoms, offset=1)
+        sparse_idx = torch.stack((atom_idx[pair_idx[0]], atom_idx[pair_idx[1]]), dim=1)
         atom_feats = self.get_atom_features(mol, atom_idx)
         bond_feats = self.get_bond_features(mol)
         atom_graph = torch.zeros((n_atoms, self.max_nbonds), dtype=torch.int64)
@@ -157,7 +183,7 @@ class RxnGraphDataset(RxnDataset):
             n_bonds[a2] += 1
 
         bond_labels = self.get_bond_labels(edits, n_atoms, sparse_idx)
-        binary_feats = self.get_binary_features(react_smiles, n_atoms)
+        binary_feats = self.get_binary_features(mol, n_atoms)
         output = {"atom_feats": atom_feats,
                   "bond_feats": bond_feats,
                   "atom_graph": atom_graph,
@@ -174,23 +200,27 @@ class RxnGraphDataset(RxnDataset):
         degrees = [atom.GetDegree() for atom in mol.GetAtoms()]
         expl_vals = [atom.GetExplicitValence() for atom in mol.GetAtoms()]
 
-        t_symbol = self.to_one_hot(self.symbol_codec, symbols)
-        t_degree = self.to_one_hot(self.degree_codec, degrees)
-        t_expl_val = self.to_one_hot(self.expl_val_codec, expl_vals)
+        t_symbol = self.to_one_hot(self.symbol_idx, symbols)
+        t_degree = self.to_one_hot(self.degree_idx, degrees)
+        t_expl_val = self.to_one_hot(self.expl_val_idx, expl_vals)
         t_aromatic = torch.tensor([atom.GetIsAromatic() for atom in mol.GetAtoms()]).float().unsqueeze(1)
         return torch.cat((t_symbol, t_degree, t_expl_val, t_aromatic), dim=1)[atom_idx]
 
     def get_bond_features(self, mol):
         bond_types = [bond.GetBondType() for bond in mol.GetBonds()]
-        t_bond_types = self.to_one_hot(self.bond_type_codec, bond_types)
+        t_bond_types = self.to_one_hot(self.bond_type_idx, bond_types)
         t_conjugated = torch.tensor([bond.GetIsConjugated() for bond in mol.GetBonds()]).float().unsqueeze(1)
         t_in_ring = torch.tensor([bond.IsInRing() for bond in mol.GetBonds()]).float().unsqueeze(1)
         return torch.cat((t_bond_types, t_conjugated, t_in_ring), dim=1)
 
     @staticmethod
-    def to_one_hot(codec, values):
-        value_idxs = codec.transform(values)
-        return torch.eye(len(codec.classes_), dtype=torch.float)[value_idxs]
+    def index_map(codec):
+        return {value: i for i, value in enumerate(codec.classes_)}
+
+    @staticmethod
+    def to_one_hot(index_map, values):
+        value_idxs = [index_map[value] for value in values]
+        return torch.eye(len(index_map), dtype=torch.float)[value_idxs]
 
     @staticmethod
     def get_bond_labels(edits, n_atoms, sparse_idx):
@@ -208,37 +238,29 @@ class RxnGraphDataset(RxnDataset):
         bond_labels = bond_labels[sparse_idx[:,0],sparse_idx[:,1]]
         return bond_labels
 
-    def get_binary_features(self, smiles, n_atoms):
-        comp = {}
-        for i, s in enumerate(smiles.split('.')):
-            mol = Chem.MolFromSmiles(s)
-            for atom in mol.GetAtoms():
-                comp[atom.GetIntProp('molAtomMapNumber') - 1] = i
-        n_comp = len(smiles.split('.'))
-        rmol = Chem.MolFromSmiles(smiles)
-        bond_map = {}
-        for bond in rmol.GetBonds():
-            a1 = bond.GetBeginAtom().GetIntProp('molAtomMapNumber') - 1
-            a2 = bond.GetEndAtom().GetIntProp('molAtomMapNumber') - 1
-            bond_map[(a1, a2)] = bond
+    def get_binary_features(self, mol, n_atoms):
+        comp = torch.empty((n_atoms,), dtype=torch.int64)
+        frags = Chem.GetMolFrags(mol)
+        for i, frag in enumerate(frags):
+            for atom_idx in frag:
+                comp[mol.GetAtomWithIdx(atom_idx).GetIntProp('molAtomMapNumber') - 1] = i
+        n_comp = len(frags)
+        off_diag = ~torch.eye(n_atoms, dtype=torch.bool)
+        same_comp = comp.unsqueeze(0) == comp.unsqueeze(1)
 
         binary_feats = torch.zeros((n_atoms, n_atoms, 10))
-        for i in range(n_atoms):
-            for j in range(i+1, n_atoms):
-                if i == j:
-                    continue
-                if (i,j) in bond_map:
-                    bond = bond_map[(i,j)]
-                    binary_feats[i,j,1:1+6] = binary_feats[j,i,1:1+6] = self.bond_features(bond)
-                elif (j,i) in bond_map:
-                    bond = bond_map[(j,i)]
-                    binary_feats[i,j,1:1+6] = binary_feats[j,i,1:1+6] = self.bond_features(bond)
-                else:
-                    binary_feats[i,j,0] = binary_feats[j,i,0] = 1.0
-                binary_feats[i,j,-4] = binary_feats[j,i,-4] = 1.0 if comp[i] != comp[j] else 0.0
-                binary_feats[i,j,-3] = binary_feats[j,i,-3] = 1.0 if comp[i] == comp[j] else 0.0
-                binary_feats[i,j,-2] = binary_feats[j,i,-2] = 1.0 if n_comp == 1 else 0.0
-                binary_feats[i,j,-1] = binary_feats[j,i,-1] = 1.0 if n_comp > 1 else 0.0
+        binary_feats[:,:,0] = off_diag.float()
+        for bond in mol.GetBonds():
+            a1 = bond.GetBeginAtom().GetIntProp('molAtomMapNumber') - 1
+            a2 = bond.GetEndAtom().GetIntProp('molAtomMapNumber') - 1
+            binary_feats[a1,a2,0] = binary_feats[a2,a1,0] = 0.0
+            binary_feats[a1,a2,1:1+6] = binary_feats[a2,a1,1:1+6] = self.bond_features(bond)
+        binary_feats[:,:,-4] = (off_diag & ~same_comp).float()
+        binary_feats[:,:,-3] = (off_diag & same_comp).float()
+        if n_comp == 1:
+            binary_feats[:,:,-2] = off_diag.float()
+        else:
+            binary_feats[:,:,-1] = off_diag.float()
         return binary_feats
 
     @staticmethod
@@ -5,7 +5,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as opt
+from torch.nn.utils.rnn import pad_sequence
 
+from ..utils import total_norm
 from .wln import WLNet
 from .attention import Attention
 from .reactivity_scoring import ReactivityScoring
@@ -23,17 +25,22 @@ class ReactivityNet(nn.Module):
         local_features = self.wln(fatoms, fbonds, atom_nb, bond_nb, num_nbs, n_atoms, mask_neis, mask_atoms)
         local_pair, global_pair = self.attention(local_features, binary_feats, sparse_idx)
         pair_scores = self.reactivity_scoring(local_pair, global_pair, binary_feats, sparse_idx)
-        sample_idxs = [torch.where(sparse_idx[:,0] == i)[0] for i in range(local_features.shape[0])]
-        sample_scores = [pair_scores[sample_idx] for sample_idx in sample_idxs]
-        sample_topks = [torch.topk(sample_score.flatten(), 80) for sample_score in sample_scores]
-        topks = torch.stack([topk for (_, topk) in sample_topks], dim=0)
+        # Pairs are grouped by sample in sparse_idx, so each sample's pairs are a contiguous block.
+        batch_size = local_features.shape[0]
+        n_pairs = torch.bincount(sparse_idx[:,0], minlength=batch_size)
+        pair_range = torch.arange(sparse_idx.shape[0], device=sparse_idx.device)
+        sample_idxs = torch.split(pair_range, n_pairs.tolist())
+        sample_pos = pair_range - (torch.cumsum(n_pairs, dim=0) - n_pairs)[sparse_idx[:,0]]
+        sample_scores = pair_scores.new_full((batch_size, int(n_pairs.max()), pair_scores.shape[-1]), float('-inf'))
+        sample_scores[sparse_idx[:,0], sample_pos] = pair_scores.detach()
+        _, topks = torch.topk(sample_scores.flatten(start_dim=1), 80)
         return pair_scores, topks, sample_idxs
 
 
 class ReactivityTrainer(nn.Module):
     def __init__(self, rxn_net, lr=1e-4, betas=(0.9, 0.999), weight_decay=0.01, with_cuda=True,
                  cuda_devices=None, log_freq=10, grad_clip=None, pos_weight=1.0, lr_decay=0.9,
-                 lr_steps=10000):
+                 lr_steps=10000, compile_model=False):
         super(ReactivityTrainer, self).__init__()
         cuda_condition = torch.cuda.is_available() and with_cuda
         self.device = torch.device("cuda" if cuda_condition else "cpu")
@@ -42,14 +49,23 @@ class ReactivityTrainer(nn.Module):
             logging.info("Using {} GPUS".format(torch.cuda.device_count()))
             self.model = nn.DataParallel(self.model, device_ids=cuda_devices)
         self.model.to(self.device)
+        if compile_model:
+            if hasattr(torch, "compile"):
+                self.model = torch.compile(self.model, dynamic=True)
+            else:
+                logging.warning("torch.compile requires PyTorch 2.0 or later, training the model uncompiled")
         self.lr = lr
         self.lr_decay = lr_decay
         self.lr_steps = lr_steps
         self.grad_clip = grad_clip
         self.log_freq = log_freq
-        self.pos_weight = pos_weight
+        # Only weights the positive term of the loss, so a single value covers every label
+        self.pos_weight = torch.tensor([pos_weight], device=self.device) if pos_weight is not None else None
         self.total_iters = 0
+        self.nbonds_range = torch.arange(0, 10, dtype=torch.int32, device=self.device)
+        self.atoms_range = torch.arange(0, 256, dtype=torch.int32, device=self.device)
         self.optimizer = opt.Adam(self.model.parameters(), lr=self.lr, betas=betas, weight_decay=weight_decay)
+        self.scheduler = opt.lr_scheduler.StepLR(self.optimizer, step_size=self.lr_steps, gamma=self.lr_decay)
 
     def train_epoch(self, epoch, data_loader):
         logging.info("{:-^80}".format("Training"))
@@ -61,6 +77,14 @@ class ReactivityTrainer(nn.Module):
         self.model.eval()
         self.iterate(epoch, data_loader, train=False)
 
+    def get_atoms_range(self, n_atoms):
+        if n_atoms > self.atoms_range.numel():
+            size = self.atoms_range.numel()
+            while size < n_atoms:
+                size *= 2
+            self.atoms_range = torch.arange(0, size, dtype=torch.int32, device=self.device)
+        return self.atoms_range[:n_atoms]
+
     def iterate(self, epoch, data_loader, train=True):
         avg_loss = test_loss = 0.0
         sum_gnorm = 0.0
@@ -73,25 +97,15 @@ class ReactivityTrainer(nn.Module):
             data = {key: value.to(self.device) for key, value in data.items()}
 
             # Create some masking logic for padding
-            mask_neis = torch.unsqueeze(
-                data['n_bonds'].unsqueeze(-1) > torch.arange(0, 10, dtype=torch.int32, device=self.device).view(1, 1, -1), -1)
-            max_n_atoms = data['n_atoms'].max()
-            mask_atoms = torch.unsqueeze(
-                data['n_atoms'].unsqueeze(-1) > torch.arange(0, max_n_atoms, dtype=torch.int32, device=self.device).view(1, -1),
-                -1)
-
-            pair_scores, top_k, sample_idxs = self.model.forward(data['atom_feats'], data['bond_feats'],
-                                                    data['atom_graph'], data['bond_graph'], data['n_bonds'],
-                                                    data['n_atoms'], data['binary_feats'], mask_neis, mask_atoms,
-                                                    data['sparse_idx'])
-            if self.pos_weight is not None:
-                pos_weight = torch.where(data['bond_labels'] == 1.0,
-                                         self.pos_weight * torch.ones_like(data['bond_labels']),
-                                         torch.ones_like(data['bond_labels']))
-            else:
-                pos_weight = None
-            loss = F.binary_cross_entropy_with_logits(pair_scores, data['bond_labels'], reduction='none', pos_weight=pos_weight)
-            loss = torch.mean(loss)
+            mask_neis = (data['n_bonds'].unsqueeze(-1) > self.nbonds_range.view(1, 1, -1))[..., None]
+            max_n_atoms = int(data['n_atoms'].max())
+            mask_atoms = (data['n_atoms'].unsqueeze(-1) > self.get_atoms_range(max_n_atoms).view(1, -1))[..., None]
+
+            pair_scores, top_k, sample_idxs = self.model(data['atom_feats'], data['bond_feats'],
+                                                         data['atom_graph'], data['bond_graph'], data['n_bonds'],
+                                                         data['n_atoms'], data['binary_feats'], mask_neis, mask_atoms,
+                                                         data['sparse_idx'])
+            loss = F.binary_cross_entropy_with_logits(pair_scores, data['bond_labels'], pos_weight=self.pos_weight)
             avg_loss += loss.item()
             test_loss += loss.item()
 
@@ -99,42 +113,43 @@ class ReactivityTrainer(nn.Module):
                 self.total_iters += 1
                 self.optimizer.zero_grad()
                 loss.backward()
-                param_norm = torch.sqrt(sum([torch.sum(param ** 2) for param in self.model.parameters()])).item()
-                grad_norm = torch.sqrt(sum([torch.sum(param.grad ** 2) for param in self.model.parameters()])).item()
-                sum_gnorm += grad_norm
                 if self.grad_clip is not None:
-                    nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+                    grad_norm = nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+                else:
+                    grad_norm = total_norm([param.grad for param in self.model.parameters() if param.grad is not None])
+                sum_gnorm += grad_norm
+                if (i+1) % self.log_freq == 0:
+                    param_norm = total_norm(self.model.parameters()).item()
                 self.optimizer.step()
 
             batch_size = len(sample_idxs)
-            bond_labels = [data['bond_labels'][sample_idx] for sample_idx in sample_idxs]
-            sp_labels = [torch.stack(torch.where(bond_label.flatten() == 1), dim=-1) for bond_label in bond_labels]
-
-            hits_10 = [(sp_labels[i] == top_k[i][:10].unsqueeze(0)).any(dim=1) for i in range(batch_size)]
-            hits_12 = [(sp_labels[i] == top_k[i][:12].unsqueeze(0)).any(dim=1) for i in range(batch_size)]
-            hits_16 = [(sp_labels[i] == top_k[i][:16].unsqueeze(0)).any(dim=1) for i in range(batch_size)]
-            hits_20 = [(sp_labels[i] == top_k[i][:20].unsqueeze(0)).any(dim=1) for i in range(batch_size)]
-            hits_40 = [(sp_labels[i] == top_k[i][:40].unsqueeze(0)).any(dim=1) for i in range(batch_size)]
-            hits_80 = [(sp_labels[i] == top_k[i].unsqueeze(0)).any(dim=1) for i in range(batch_size)]
-            all_correct_10 = [mol_hits.all().int() for mol_hits in hits_10]
-            all_correct_12 = [mol_hits.all().int() for mol_hits in hits_12]
-            all_correct_16 = [mol_hits.all().int() for mol_hits in hits_16]
-            all_correct_20 = [mol_hits.all().int() for mol_hits in hits_20]
-            all_correct_40 = [mol_hits.all().int() for mol_hits in hits_40]
-            all_correct_80 = [mol_hits.all().int() for mol_hits in hits_80]
-
-            sum_acc10 += sum(all_correct_10).item()
-            sum_acc12 += sum(all_correct_12).item()
-            sum_acc16 += sum(all_correct_16).item()
-            sum_acc20 += sum(all_correct_20).item()
-            sum_acc40 += sum(all_correct_40).item()
-            sum_acc80 += sum(all_correct_80).item()
-            test_acc10 += sum(all_correct_10).item()
-            test_acc12 += sum(all_correct_12).item()
-            test_acc16 += sum(all_correct_16).item()
-            test_acc20 += sum(all_correct_20).item()
-            test_acc40 += sum(all_correct_40).item()
-            test_acc80 += sum(all_correct_80).item()
+            # Index the positive labels the same way as top_k, by position in each sample's flattened scores.
+            label_rows, label_cols = (data['bond_labels'] == 1).nonzero(as_tuple=True)
+            label_mols = data['sparse_idx'][label_rows, 0]
+            n_pairs = torch.bincount(data['sparse_idx'][:,0], minlength=batch_size)
+            sp_labels = (label_rows - (torch.cumsum(n_pairs, dim=0) - n_pairs)[label_mols]) * \
+                data['bond_labels'].shape[-1] + label_cols
+            n_labels = torch.bincount(label_mols, minlength=batch_size)
+            labels_pad = pad_sequence(torch.split(sp_labels, n_labels.tolist()), batch_first=True, padding_value=-1)
+            hits = labels_pad.unsqueeze(-1) == top_k.unsqueeze(1)
+            label_pad_mask = labels_pad == -1
+            all_correct = torch.stack([(hits[:,:,:k].any(dim=-1) | label_pad_mask).all(dim=-1).sum()
+                                       for k in (10, 12, 16, 20, 40, 80)])
+            all_correct_10, all_correct_12, all_correct_16, all_correct_20, all_correct_40, all_correct_80 = (
+                all_correct.tolist())
+
+            sum_acc10 += all_correct_10
+            sum_acc12 += all_correct_12
+            sum_acc16 += all_correct_16
+            sum_acc20 += all_correct_20
+            sum_acc40 += all_correct_40
+            sum_acc80 += all_correct_80
+            test_acc10 += all_correct_10
+            test_acc12 += all_correct_12
+            test_acc16 += all_correct_16
+            test_acc20 += all_correct_20
+            test_acc40 += all_correct_40
+            test_acc80 += all_correct_80
 
             if (i+1) % self.log_freq == 0:
                 if train:
@@ -150,7 +165,7 @@ class ReactivityTrainer(nn.Module):
                         "acc40": sum_acc40 / (self.log_freq * batch_size),
                         "acc80": sum_acc80 / (self.log_freq * batch_size),
                         "pnorm": param_norm,
-                        "gnorm": sum_gnorm
+                        "gnorm": float(sum_gnorm)
                     }
                     logging.info(("Epoch: {epoch:2d}  Iter: {iter:5d}  Loss: {avg_loss:7.5f}  Acc @10: {acc10:6.2%}  "
                         "@12: {acc12:6.2%}  @16: {acc16:6.2%}  @20: {acc20:6.2%}  @40: {acc40:6.2%}  @80: {acc80:6.2%}  "  
@@ -177,11 +192,11 @@ class ReactivityTrainer(nn.Module):
                 avg_loss = 0.0
                 sum_gnorm = 0.0
 
-            if self.total_iters % self.lr_steps == 0:
-                for param_group in self.optimizer.param_groups:
-                    param_group['lr'] *= self.lr_decay
-                logging.info("Learning rate changed to {:f}".format(
-                    self.optimizer.param_groups[0]['lr']))
+            if train:
+                self.scheduler.step()
+                if self.total_iters % self.lr_steps == 0:
+                    logging.info("Learning rate changed to {:f}".format(
+                        self.optimizer.param_groups[0]['lr']))
         if not train:
             logging.info("Epoch: {:2d}  Loss: {:f}  Accuracy @10: {:6.2%}  @12: {:6.2%}  @16: {:6.2%}  "
                          "@20: {:6.2%}  @40: {:6.2%}  @80: {:6.2%}".format(epoch,
@@ -191,6 +206,7 @@ class ReactivityTrainer(nn.Module):
     def save(self, epoch, filename, path):
         filename = filename + ".ep%d" % epoch
         output = os.path.join(path, filename)
-        torch.save(self.model.cpu(), output)
+        # Save the underlying module rather than the torch.compile wrapper
+        torch.save(getattr(self.model, "_orig_mod", self.model).cpu(), output)
         self.model.to(self.device)
         logging.info("Model saved to {} in {}:".format(filename, path))
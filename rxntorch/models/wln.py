@@ -23,13 +23,13 @@ class WLNet(nn.Module):
                 atomnei_feats = self.fc2atom_nei(atomnei_feats)
                 bondnei_feats = self.fc2bond_nei(bondnei_feats)
                 nei_feats = atomnei_feats * bondnei_feats
-                nei_feats = torch.where(mask_neis, nei_feats, torch.zeros_like(nei_feats)).sum(-2)
+                nei_feats = nei_feats.masked_fill(~mask_neis, 0.0).sum(-2)
                 self_feats = self.fc2(atom_feats)
                 local_feats = self_feats * nei_feats
-                local_feats = torch.where(mask_atoms, local_feats, torch.zeros_like(local_feats))
+                local_feats = local_feats.masked_fill(~mask_atoms, 0.0)
             else:
                 nei_feats = F.relu(self.graph_conv_nei(torch.cat([atomnei_feats, bondnei_feats], dim=-1)))
-                nei_feats = torch.where(mask_neis, nei_feats, torch.zeros_like(nei_feats)).sum(-2)
+                nei_feats = nei_feats.masked_fill(~mask_neis, 0.0).sum(-2)
                 update_feats = torch.cat([atom_feats, nei_feats], dim=-1)
                 atom_feats = F.relu(self.graph_conv_atom(update_feats))
         return local_feats
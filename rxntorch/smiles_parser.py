@@ -87,6 +87,40 @@ def parser(input_smiles):
 	return parse(input_smiles, SMILES)
 
 
+# single pass tokenizer
+
+TWO_CHAR_SYMBOLS = {'Br', 'Cl', 'as', 'se'}
+ONE_CHAR_TOKENS = set('BCNOPSFIbcnops*()-=#$:/\\.0123456789')
+
+def tokenize_smiles(input_smiles):
+	i = 0
+	n = len(input_smiles)
+	while i < n:
+		c = input_smiles[i]
+		if c == '[':
+			j = input_smiles.index(']', i) + 1
+			token = input_smiles[i:j]
+			if '++' in token: token = token.replace('++', '+2')
+			elif '--' in token: token = token.replace('--', '-2')
+			yield token
+			i = j
+		elif input_smiles[i:i+2] in TWO_CHAR_SYMBOLS:
+			yield input_smiles[i:i+2]
+			i += 2
+		elif c == '%':
+			ring = input_smiles[i+1:i+3]
+			if(len(ring) != 2 or not ring.isdigit()):
+				raise ValueError("Invalid ring closure in SMILES: %s" % input_smiles)
+			if(int(ring) < 10): yield ring
+			else: yield ''.join(['%', ring])
+			i += 3
+		elif c in ONE_CHAR_TOKENS:
+			yield c
+			i += 1
+		else:
+			raise ValueError("Unexpected character %r in SMILES: %s" % (c, input_smiles))
+
+
 # parse to list of string
 
 def parser_list(input_object, isParsed = False):
@@ -126,7 +160,7 @@ def parser_list(input_object, isParsed = False):
 		return []
 
 	if not isParsed:
-		input_object = parser(input_object)
+		return list(tokenize_smiles(input_object))
 
 	for k in input_object:
 
@@ -135,7 +169,7 @@ def parser_list(input_object, isParsed = False):
 			parsed_list.append(parse_class_str(k))
 
 		elif isinstance(k, List):
-			parsed_list += parser_list(k, True)
+			parsed_list.extend(parser_list(k, True))
 
 	return parsed_list
 
@@ -229,10 +263,10 @@ def parser_json(input_object, isParsed = False, isFinal = True):
 	for k in input_object:
 		if isinstance(k, (OrganicSymbol, AromaticSymbol, WILDCARD, \
 			OpenBranch, CloseBranch, RingClosure, AtomSpec)):
-			parsed_json = parsed_json + [parse_class_json(k)]
+			parsed_json.append(parse_class_json(k))
 
 		elif isinstance(k, List):
-			parsed_json = parsed_json + parser_json(k, True, False)
+			parsed_json.extend(parser_json(k, True, False))
 
 	# TODO: needs refactoring
 	if not isFinal:
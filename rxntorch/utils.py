@@ -32,3 +32,15 @@ def collate_fn(batch_data):
         output[key] = values
     return output
 
+
+def total_norm(tensors):
+    """
+    Computes the L2 norm over a collection of tensors, as if they were
+    flattened and concatenated, without syncing with the host
+    """
+    tensors = [tensor.detach() for tensor in tensors]
+    if hasattr(torch, "_foreach_norm"):
+        norms = torch._foreach_norm(tensors)
+    else:
+        norms = [tensor.norm() for tensor in tensors]
+    return torch.norm(torch.stack(norms))
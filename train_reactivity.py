@@ -38,6 +38,7 @@ parser.add_argument("-pw", "--pos_weight", type=float, default=None, help="Weigh
 parser.add_argument("-w", "--num_workers", type=int, default=4, help="dataloader worker size")
 parser.add_argument("--with_cuda", type=bool, default=True, help="training with CUDA: true, or false")
 parser.add_argument("--cuda_devices", type=int, nargs='*', default=None, help="CUDA device ids")
+parser.add_argument("--compile", action="store_true", help="compile the model with torch.compile (PyTorch 2.0+)")
 
 parser.add_argument("--log_freq", type=int, default=50, help="printing loss every n iter: setting n")
 
@@ -54,7 +55,7 @@ logging.basicConfig(level=logging.INFO, style='{', format="{asctime:s}: {message
                     logging.FileHandler(logpath), logging.StreamHandler()))
 
 logging.info("{:-^80}".format("Dataset"))
-dataset = RxnGD(args.train_dataset, path=args.dataset_path)
+dataset = RxnGD(args.train_dataset, path=args.dataset_path, num_workers=args.num_workers)
 sample = dataset[0]
 afeats_size, bfeats_size, binary_size = (sample["atom_feats"].shape[-1], sample["bond_feats"].shape[-1],
                                         sample["binary_feats"].shape[-1])
@@ -92,7 +93,7 @@ logging.info("Weight decay: {}  Gradient clipping: {}  Positive sample weighting
 trainer = RxnTrainer(net, lr=args.lr, betas=(args.adam_beta1, args.adam_beta2), weight_decay=args.adam_weight_decay,
                      with_cuda=args.with_cuda, cuda_devices=args.cuda_devices, log_freq=args.log_freq,
                      grad_clip=args.grad_clip, pos_weight=args.pos_weight, lr_decay=args.lr_decay,
-                     lr_steps=args.lr_steps)
+                     lr_steps=args.lr_steps, compile_model=args.compile)
 
 for epoch in range(args.epochs):
     trainer.train_epoch(epoch, train_dataloader)